@@ -17,8 +17,8 @@ def get_fitbit_oauth():
     )
 
 
-def get_fitbit_session():
-    token_data = db["tokens"].find_one({"user": "default"})
+def get_fitbit_session(user="default"):
+    token_data = db["tokens"].find_one({"user": user})
     if not token_data:
         return None
     return OAuth2Session(CLIENT_ID, token=token_data["oauth_token"])
@@ -0,0 +1,360 @@
+# calibration.py
+import argparse
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from config import CALIBRATION_EVENT_WINDOW_MINUTES, CALIBRATION_BACKGROUND_WEIGHT, CALIBRATION_SPARK_MIN_SAMPLES, \
+    CALIBRATION_SENSITIVE_RECALL, SPARK_MASTER
+
+EPOCH = datetime(1970, 1, 1)
+HRV_FEATURES = ["rmssd", "hf", "lf", "coverage"]
+PROFILE_KEYS = {
+    "rmssd": "PANIC_THRESHOLD_RMSSD",
+    "hf": "PANIC_THRESHOLD_HF",
+    "lf": "PANIC_THRESHOLD_LF",
+    "coverage": "PANIC_THRESHOLD_COVERAGE",
+    "hr_spike_increase": "PANIC_THRESHOLD_HR_SPIKE_INCREASE",
+    "hr_sustained_duration": "PANIC_THRESHOLD_HR_SUSTAINED_DURATION"
+}
+HR_SPIKE_VALUES = np.arange(1, 31)  # BPM increase between consecutive minutes
+HR_DURATION_VALUES = np.arange(1, 16)  # Minutes of consecutive spikes
+MAX_FLAG_CELLS = 10_000_000  # Upper bound on grid x samples booleans evaluated at once
+
+
+def to_minutes(dt):
+    return int((dt - EPOCH).total_seconds() // 60)
+
+
+def event_interval(event):
+    """
+    Minute interval covered by a stored panic attack, or None for day-level events
+    (heart rate zone analysis) that can't be tied to specific samples.
+    """
+    timestamp = str(event["timestamp"])
+    metrics = event.get("metrics", {})
+    if "start_time" in metrics and "end_time" in metrics:
+        start = datetime.strptime(f"{timestamp[:10]} {metrics['start_time']}", "%Y-%m-%d %H:%M:%S")
+        end = datetime.strptime(f"{timestamp[:10]} {metrics['end_time']}", "%Y-%m-%d %H:%M:%S")
+        if end < start:
+            end += timedelta(days=1)
+        return to_minutes(start), to_minutes(end)
+    if "T" in timestamp:
+        minute = to_minutes(datetime.strptime(timestamp[:16], "%Y-%m-%dT%H:%M"))
+        return minute, minute
+    return None
+
+
+def load_history(start_date, end_date, users=None):
+    """
+    Build one dataset per user from the cached HRV / intraday heart rate history
+    and the stored panic attacks between start_date and end_date (YYYY-MM-DD).
+    Only days in fitbit_cache are used (the webhook doesn't store what it fetches),
+    run with --backfill to fill the range first. Panic attacks aren't stored per
+    user yet, so all of them are attributed to the "default" token's user.
+    """
+    # Imported here so Spark workers can unpickle calibrate_user without opening a MongoDB connection
+    from health_data import fitbit_cache_collection, panic_attacks_collection
+
+    datasets = {}
+
+    def dataset(user):
+        if user not in datasets:
+            datasets[user] = {
+                "user": user, "hrv": [], "hr": [], "confirmed": [], "unconfirmed": []
+            }
+        return datasets[user]
+
+    query = {"type": {"$in": ["hrv", "heart_rate"]}, "date": {"$gte": start_date, "$lte": end_date}}
+    if users:
+        query["user"] = {"$in": users}
+    for cached in fitbit_cache_collection.find(query, {"_id": 0}):
+        data = dataset(cached["user"])
+        if cached["type"] == "hrv":
+            for entry in cached["data"].get("hrv", []):
+                for minute_data in entry.get("minutes", []):
+                    value = minute_data["value"]
+                    data["hrv"].append((
+                        to_minutes(datetime.strptime(minute_data["minute"][:16], "%Y-%m-%dT%H:%M")),
+                        value.get("rmssd", float("inf")),
+                        value.get("hf", 0.0),
+                        value.get("lf", 0.0),
+                        value.get("coverage", 0.0)
+                    ))
+        else:
+            day = to_minutes(datetime.strptime(cached["date"], "%Y-%m-%d"))
+            intraday = cached["data"].get("activities-heart-intraday", {}).get("dataset", [])
+            for entry in intraday:
+                time_str = entry["time"]
+                data["hr"].append((day + int(time_str[:2]) * 60 + int(time_str[3:5]), day, entry["value"]))
+
+    end_of_range = (datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    for event in panic_attacks_collection.find({"timestamp": {"$gte": start_date, "$lt": end_of_range}}):
+        user = event.get("user", "default")
+        if users and user not in users:
+            continue
+        interval = event_interval(event)
+        if interval is None:
+            continue
+        key = "confirmed" if event.get("panic_attack_confirmed") else "unconfirmed"
+        dataset(user)[key].append(interval)
+
+    result = []
+    for data in datasets.values():
+        hrv = np.array(sorted(data["hrv"]), dtype=np.float64).reshape(-1, 1 + len(HRV_FEATURES))
+        hr = np.array(sorted(data["hr"]), dtype=np.int64).reshape(-1, 3)
+        result.append({
+            "user": data["user"],
+            "hrv_timestamps": hrv[:, 0].astype(np.int64),
+            "hrv_features": hrv[:, 1:],
+            "hr_timestamps": hr[:, 0],
+            "hr_days": hr[:, 1],
+            "hr_values": hr[:, 2].astype(np.float64),
+            "confirmed": np.array(data["confirmed"], dtype=np.int64).reshape(-1, 2),
+            "unconfirmed": np.array(data["unconfirmed"], dtype=np.int64).reshape(-1, 2)
+        })
+    return result
+
+
+def in_intervals(timestamps, intervals, window):
+    """
+    Boolean mask of timestamps falling inside any interval padded by window minutes.
+    """
+    if not len(intervals) or not len(timestamps):
+        return np.zeros(len(timestamps), dtype=bool)
+    intervals = intervals[np.argsort(intervals[:, 0])]
+    starts = intervals[:, 0] - window
+    # Running max of the ends handles overlapping intervals
+    ends = np.maximum.accumulate(intervals[:, 1] + window)
+    idx = np.searchsorted(starts, timestamps, side="right") - 1
+    return (idx >= 0) & (timestamps <= ends[np.maximum(idx, 0)])
+
+
+def label_samples(timestamps, confirmed, unconfirmed, window, background_weight):
+    """
+    Samples near a confirmed attack are positives, samples near an unconfirmed
+    detection are explicit negatives with weight 1 and all others are negatives
+    weighted by background_weight (below 1 by default).
+    """
+    positives = in_intervals(timestamps, confirmed, window)
+    weights = np.where(in_intervals(timestamps, unconfirmed, window), 1.0, background_weight)
+    weights[positives] = 1.0
+    return positives, weights
+
+
+def count_flags(flags, positives, negative_weights):
+    return flags @ positives, flags @ negative_weights
+
+
+def evaluate_hrv_grid(features, positives, weights, grid):
+    """
+    True and false positive counts of the HRV rule in analyze_hrv_data for
+    every row of grid (rmssd, hf, lf, coverage), evaluated in chunks.
+    """
+    pos = positives.astype(np.float64)
+    neg = np.where(positives, 0.0, weights)
+    tp = np.zeros(len(grid))
+    fp = np.zeros(len(grid))
+    chunk = max(1, MAX_FLAG_CELLS // max(len(features), 1))
+    for start in range(0, len(grid), chunk):
+        g = grid[start:start + chunk, :, None]
+        flags = (
+            (features[None, :, 0] <= g[:, 0]) &
+            (features[None, :, 1] >= g[:, 1]) &
+            (features[None, :, 2] >= g[:, 2]) &
+            (features[None, :, 3] >= g[:, 3])
+        )
+        tp[start:start + chunk], fp[start:start + chunk] = count_flags(flags, pos, neg)
+    return tp, fp
+
+
+def run_lengths(mask):
+    """
+    Length of the run of consecutive True values ending at each position.
+    """
+    counts = np.cumsum(mask)
+    resets = np.maximum.accumulate(np.where(mask, 0, counts))
+    return counts - resets
+
+
+def evaluate_hr_grid(hr_values, hr_days, positives, weights, spike_values, duration_values):
+    """
+    True and false positive counts of the sustained spike rule in
+    analyze_heart_rate_zones for every (spike increase, duration) pair.
+    A sample is flagged once the spike has lasted the given number of minutes.
+    """
+    pos = positives.astype(np.float64)
+    neg = np.where(positives, 0.0, weights)
+    increase = np.diff(hr_values, prepend=np.nan)
+    same_day = np.diff(hr_days, prepend=-1) == 0
+    tp = np.zeros((len(spike_values), len(duration_values)))
+    fp = np.zeros((len(spike_values), len(duration_values)))
+    for i, spike in enumerate(spike_values):
+        runs = run_lengths(same_day & (increase >= spike))
+        flags = runs[None, :] >= duration_values[:, None]
+        tp[i], fp[i] = count_flags(flags, pos, neg)
+    return tp.ravel(), fp.ravel()
+
+
+def quantile_grid(values, steps):
+    finite = values[np.isfinite(values)]
+    if not len(finite):
+        return np.array([0.0])
+    return np.unique(np.quantile(finite, np.linspace(0, 1, steps)))
+
+
+def summarize(names, grid, tp, fp, total_positives, beta, sensitive_recall):
+    """
+    Precision/recall curve (Pareto front) and recommended thresholds for one rule.
+    """
+    recall = tp / total_positives
+    precision = np.divide(tp, tp + fp, out=np.zeros_like(tp), where=(tp + fp) > 0)
+    beta2 = beta ** 2
+    f_beta = np.divide((1 + beta2) * precision * recall, beta2 * precision + recall,
+                       out=np.zeros_like(tp), where=(beta2 * precision + recall) > 0)
+
+    def point(i):
+        # item() keeps the integer heart rate grid as ints, health_data parses those thresholds with int()
+        thresholds = {name: value.item() for name, value in zip(names, grid[i])}
+        return {"thresholds": thresholds, "precision": round(float(precision[i]), 4),
+                "recall": round(float(recall[i]), 4), "f_beta": round(float(f_beta[i]), 4)}
+
+    # Highest recall first, then keep only points that improve on the best precision so far
+    order = np.lexsort((-precision, -recall))
+    best = np.maximum.accumulate(precision[order])
+    front = order[np.concatenate(([True], precision[order][1:] > best[:-1]))]
+    curve = [point(i) for i in front[::-1]]
+
+    sensitive = np.flatnonzero(recall >= sensitive_recall)
+    return {
+        "curve": curve,
+        "recommended": point(int(np.argmax(f_beta))),
+        "sensitive": point(int(sensitive[np.argmax(precision[sensitive])])) if len(sensitive) else None
+    }
+
+
+def to_profile(*points):
+    profile = {}
+    for p in points:
+        if p:
+            profile.update({PROFILE_KEYS[name]: value for name, value in p["thresholds"].items()})
+    return profile
+
+
+def calibrate_user(dataset, steps=8, beta=1.0, window=None, background_weight=None, sensitive_recall=None):
+    """
+    Grid-search the HRV and heart rate spike thresholds for one user's dataset.
+    """
+    window = int(CALIBRATION_EVENT_WINDOW_MINUTES) if window is None else window
+    background_weight = float(CALIBRATION_BACKGROUND_WEIGHT) if background_weight is None else background_weight
+    sensitive_recall = float(CALIBRATION_SENSITIVE_RECALL) if sensitive_recall is None else sensitive_recall
+    result = {
+        "user": dataset["user"],
+        "confirmed_events": len(dataset["confirmed"]),
+        "unconfirmed_events": len(dataset["unconfirmed"]),
+        "hrv_samples": len(dataset["hrv_timestamps"]),
+        "hr_samples": len(dataset["hr_timestamps"])
+    }
+
+    positives, weights = label_samples(dataset["hrv_timestamps"], dataset["confirmed"], dataset["unconfirmed"],
+                                       window, background_weight)
+    if positives.any():
+        features = dataset["hrv_features"]
+        axes = [quantile_grid(features[:, i], steps) for i in range(len(HRV_FEATURES))]
+        grid = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, len(HRV_FEATURES))
+        tp, fp = evaluate_hrv_grid(features, positives, weights, grid)
+        result["hrv"] = summarize(HRV_FEATURES, grid, tp, fp, positives.sum(), beta, sensitive_recall)
+
+    positives, weights = label_samples(dataset["hr_timestamps"], dataset["confirmed"], dataset["unconfirmed"],
+                                       window, background_weight)
+    if positives.any():
+        tp, fp = evaluate_hr_grid(dataset["hr_values"], dataset["hr_days"], positives, weights,
+                                  HR_SPIKE_VALUES, HR_DURATION_VALUES)
+        grid = np.stack(np.meshgrid(HR_SPIKE_VALUES, HR_DURATION_VALUES, indexing="ij"), axis=-1).reshape(-1, 2)
+        result["heart_rate_spike"] = summarize(["hr_spike_increase", "hr_sustained_duration"], grid, tp, fp,
+                                               positives.sum(), beta, sensitive_recall)
+
+    if "hrv" not in result and "heart_rate_spike" not in result:
+        result["error"] = "No samples near confirmed panic attacks"
+        return result
+
+    result["profiles"] = {
+        "recommended": to_profile(result.get("hrv", {}).get("recommended"),
+                                  result.get("heart_rate_spike", {}).get("recommended")),
+        "sensitive": to_profile(result.get("hrv", {}).get("sensitive"),
+                                result.get("heart_rate_spike", {}).get("sensitive"))
+    }
+    return result
+
+
+def calibrate_with_spark(datasets, **kwargs):
+    """
+    Run calibrate_user for every dataset on a local Spark context, one task per user.
+    """
+    from pyspark.sql import SparkSession
+
+    spark = SparkSession.builder.master(SPARK_MASTER).appName("CalmWatchCalibration").getOrCreate()
+    try:
+        rdd = spark.sparkContext.parallelize(datasets, numSlices=max(len(datasets), 1))
+        return rdd.map(lambda dataset: calibrate_user(dataset, **kwargs)).collect()
+    finally:
+        spark.stop()
+
+
+def run_calibration(start_date, end_date, users=None, mode="auto", **kwargs):
+    """
+    Calibrate thresholds for every user with history between start_date and end_date.
+    mode is "numpy", "spark" or "auto" (Spark once the history exceeds CALIBRATION_SPARK_MIN_SAMPLES).
+    """
+    started_at = datetime.now()
+    datasets = load_history(start_date, end_date, users)
+    total_samples = sum(len(d["hrv_timestamps"]) + len(d["hr_timestamps"]) for d in datasets)
+    if mode == "auto":
+        mode = "spark" if total_samples >= int(CALIBRATION_SPARK_MIN_SAMPLES) else "numpy"
+
+    if mode == "spark":
+        results = calibrate_with_spark(datasets, **kwargs)
+    else:
+        results = [calibrate_user(dataset, **kwargs) for dataset in datasets]
+
+    finished_at = datetime.now()
+    print(f"Calibrated {len(results)} users over {total_samples} samples "
+          f"in {(finished_at - started_at).total_seconds():.1f}s ({mode})")
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "mode": mode,
+        "samples": total_samples,
+        "duration_seconds": round((finished_at - started_at).total_seconds(), 2),
+        "created_at": finished_at.isoformat(),
+        "users": results
+    }
+
+
+if __name__ == '__main__':
+    today = datetime.today()
+    parser = argparse.ArgumentParser(description="Calibrate panic attack thresholds from confirmed history")
+    parser.add_argument("--start-date", default=(today - timedelta(days=90)).strftime("%Y-%m-%d"))
+    parser.add_argument("--end-date", default=today.strftime("%Y-%m-%d"))
+    parser.add_argument("--user", action="append", dest="users")
+    parser.add_argument("--mode", choices=["auto", "numpy", "spark"], default="auto")
+    parser.add_argument("--steps", type=int, default=8, help="Quantile steps per HRV threshold")
+    parser.add_argument("--beta", type=float, default=1.0, help="F-beta used to pick the recommended profile")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    parser.add_argument("--backfill", action="store_true",
+                        help="Fetch missing HRV and heart rate days into the cache first (rate limited, can take hours)")
+    args = parser.parse_args()
+
+    if args.backfill:
+        from prefetch import backfill_daily_data
+        backfill_daily_data(args.start_date, args.end_date, ["hrv", "heart_rate"], args.users)
+
+    report = run_calibration(args.start_date, args.end_date, args.users, args.mode, steps=args.steps, beta=args.beta)
+    from health_data import threshold_calibrations_collection
+    threshold_calibrations_collection.insert_one(dict(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    for user in report["users"]:
+        print(user["user"], json.dumps(user.get("profiles", user.get("error"))))
@@ -15,6 +15,23 @@ AUTHORIZATION_BASE_URL = 'https://www.fitbit.com/oauth2/authorize'
 TOKEN_URL = 'https://api.fitbit.com/oauth2/token'
 SUBSCRIPTION_ID = os.getenv("SUBSCRIPTION_ID")
 
+# Off-peak prefetch of daily Fitbit data into the local cache
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true")
+PREFETCH_TIMES = os.getenv("PREFETCH_TIMES", "04:00,06:30")  # Comma separated HH:MM, server local time
+PREFETCH_REQUESTS_PER_HOUR = os.getenv("PREFETCH_REQUESTS_PER_HOUR", "60")  # Per-user share of the 150/hour Fitbit quota
+PREFETCH_WAKE_HOUR = os.getenv("PREFETCH_WAKE_HOUR", "6")  # Today's sleep, HRV and breathing rate aren't prefetched before this hour
+PREFETCH_LOCK_MINUTES = os.getenv("PREFETCH_LOCK_MINUTES", "30")  # Lock held (and renewed while running) so only one worker runs each prefetch
+CACHE_TTL_MINUTES = os.getenv("CACHE_TTL_MINUTES", "180")  # How long cached data for today stays fresh
+HEART_RATE_CACHE_TTL_MINUTES = os.getenv("HEART_RATE_CACHE_TTL_MINUTES", "5")  # Today's heart rate feeds "current" BPM fields
+CACHE_FINAL_AFTER_HOURS = os.getenv("CACHE_FINAL_AFTER_HOURS", "12")  # Data fetched this long after its day ended is never refetched
+
+# Offline threshold calibration over confirmed panic attacks
+CALIBRATION_EVENT_WINDOW_MINUTES = os.getenv("CALIBRATION_EVENT_WINDOW_MINUTES", "10")  # Samples this close to an event are labelled by it
+CALIBRATION_BACKGROUND_WEIGHT = os.getenv("CALIBRATION_BACKGROUND_WEIGHT", "0.2")  # Samples away from any event, kept below the weight 1 of unconfirmed detections so those dominate
+CALIBRATION_SENSITIVE_RECALL = os.getenv("CALIBRATION_SENSITIVE_RECALL", "0.9")  # Minimum recall of the sensitive profile
+CALIBRATION_SPARK_MIN_SAMPLES = os.getenv("CALIBRATION_SPARK_MIN_SAMPLES", "2000000")  # Switch to Spark above this many samples
+SPARK_MASTER = os.getenv("SPARK_MASTER", "local[*]")
+
 
 PANIC_THRESHOLD_RMSSD = os.getenv("PANIC_THRESHOLD_RMSSD")
 PANIC_THRESHOLD_HF = os.getenv("PANIC_THRESHOLD_HF")
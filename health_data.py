@@ -17,6 +17,10 @@ except Exception as e:
 db = client["health_data"]
 panic_attacks_collection = db["panic_attacks"]
 last_processed_collection = db["last_processed"]
+fitbit_cache_collection = db["fitbit_cache"]
+prefetch_runs_collection = db["prefetch_runs"]
+locks_collection = db["locks"]
+threshold_calibrations_collection = db["threshold_calibrations"]
 
 
 # Function to save panic attack event
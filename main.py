@@ -2,6 +2,7 @@
 from flask import Flask
 from flask_cors import CORS
 
+from prefetch import start_prefetch_scheduler
 from routes import routes
 import auth, os
 
@@ -17,4 +18,13 @@ app.add_url_rule('/login', 'login', auth.login)
 app.add_url_rule('/callback', 'callback', auth.callback)
 
 if __name__ == '__main__':
-    app.run(debug=True, host="0.0.0.0")
+    debug = True
+    # The debug reloader serves from a child process, only schedule prefetching there
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_prefetch_scheduler()
+    else:
+        print("Prefetch scheduler deferred to the reloader process")
+    app.run(debug=debug, host="0.0.0.0")
+else:
+    # Served as main:app by a WSGI server, every worker schedules but a MongoDB lock lets one run
+    start_prefetch_scheduler()
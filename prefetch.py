@@ -0,0 +1,206 @@
+# prefetch.py
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.combining import OrTrigger
+from apscheduler.triggers.cron import CronTrigger
+from pymongo.errors import DuplicateKeyError
+
+from auth import get_fitbit_session
+from config import PREFETCH_ENABLED, PREFETCH_TIMES, PREFETCH_REQUESTS_PER_HOUR, PREFETCH_WAKE_HOUR, \
+    PREFETCH_LOCK_MINUTES
+from health_data import db, prefetch_runs_collection, fitbit_cache_collection, locks_collection
+from service import DAILY_DATA_URLS, SLEEP_DATA_TYPES, get_cached_data, is_cache_final
+
+
+def get_registered_users():
+    return [token["user"] for token in db["tokens"].find({}, {"user": 1})]
+
+
+def acquire_prefetch_lock():
+    """
+    Take or renew the shared prefetch lock. Every WSGI worker schedules the job,
+    only the one holding the lock actually runs it.
+    """
+    now = datetime.now()
+    try:
+        locks_collection.update_one(
+            {"_id": "prefetch_daily_data", "locked_until": {"$lt": now}},
+            {"$set": {"locked_until": now + timedelta(minutes=int(PREFETCH_LOCK_MINUTES))}},
+            upsert=True)
+        return True
+    except DuplicateKeyError:
+        # The lock document exists and hasn't expired yet
+        return False
+
+
+def renew_prefetch_lock():
+    locks_collection.update_one(
+        {"_id": "prefetch_daily_data"},
+        {"$set": {"locked_until": datetime.now() + timedelta(minutes=int(PREFETCH_LOCK_MINUTES))}})
+
+
+def cache_daily_data(targets, users):
+    """
+    Fetch every (data type, date) in targets for every user into the local cache,
+    skipping days already cached as final. Requests are interleaved across users and
+    spaced so each user stays within PREFETCH_REQUESTS_PER_HOUR. Returns a coverage summary.
+    """
+    started_at = datetime.now()
+    sessions = {user: get_fitbit_session(user) for user in users}
+
+    failed = []
+    skipped = 0
+    fetched_by_type = {data_type: 0 for data_type in DAILY_DATA_URLS}
+
+    # Users without a usable token count as failures without spending any requests
+    for user in [user for user, fitbit in sessions.items() if not fitbit]:
+        for data_type, date in targets:
+            failed.append({"user": user, "type": data_type, "date": date})
+    active_users = [user for user, fitbit in sessions.items() if fitbit]
+
+    # Round-robin over users so consecutive requests for one user are a full interval apart
+    interval = 3600 / float(PREFETCH_REQUESTS_PER_HOUR) / max(len(active_users), 1)
+    jobs = []
+    for data_type, date in targets:
+        for user in active_users:
+            # Days already stored as final (e.g. viewed later that day) count as covered
+            cached = fitbit_cache_collection.find_one({"user": user, "type": data_type, "date": date})
+            if cached and is_cache_final(cached, date):
+                fetched_by_type[data_type] += 1
+                skipped += 1
+            else:
+                jobs.append((user, data_type, date))
+
+    for i, (user, data_type, date) in enumerate(jobs):
+        if i:
+            time.sleep(interval)
+            renew_prefetch_lock()
+        try:
+            data = get_cached_data(data_type, date, user=user, fitbit_session=sessions[user], refresh=True)
+        except Exception as e:
+            # A non-JSON error page or network failure shouldn't abort the rest of the run
+            print(f"Prefetch of {data_type} for {user} on {date} failed:", e)
+            failed.append({"user": user, "type": data_type, "date": date, "error": str(e)})
+            continue
+        if data is None:
+            failed.append({"user": user, "type": data_type, "date": date})
+        else:
+            fetched_by_type[data_type] += 1
+
+    finished_at = datetime.now()
+    requested_by_type = {data_type: 0 for data_type in DAILY_DATA_URLS}
+    for data_type, date in targets:
+        requested_by_type[data_type] += len(users)
+    requested = sum(requested_by_type.values())
+    fetched = sum(fetched_by_type.values())
+    return {
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "duration_seconds": round((finished_at - started_at).total_seconds(), 2),
+        "users": len(users),
+        "requested": requested,
+        "fetched": fetched,
+        "already_cached": skipped,
+        "coverage": round(fetched / requested * 100, 2) if requested else 0,
+        "coverage_by_type": {
+            data_type: round(count / requested_by_type[data_type] * 100, 2)
+            for data_type, count in fetched_by_type.items() if requested_by_type[data_type]
+        },
+        "failed": failed
+    }
+
+
+def prefetch_daily_data():
+    """
+    Warm the local cache with yesterday's and today's data for every registered token
+    and store the coverage summary of the run.
+    """
+    if not acquire_prefetch_lock():
+        print("Prefetch already running in another process, skipping")
+        return None
+
+    today = datetime.now()
+    yesterday = (today - timedelta(days=1)).strftime("%Y-%m-%d")
+    # Before the wake-up hour today's sleep-derived data is still empty, leave it to a later run
+    before_wake = today.hour < int(PREFETCH_WAKE_HOUR)
+    today = today.strftime("%Y-%m-%d")
+    targets = [(data_type, yesterday) for data_type in DAILY_DATA_URLS] + [
+        (data_type, today) for data_type in DAILY_DATA_URLS
+        if not (before_wake and data_type in SLEEP_DATA_TYPES)
+    ]
+    users = get_registered_users()
+
+    run = cache_daily_data(targets, users)
+    run["dates"] = [yesterday, today]
+    prefetch_runs_collection.insert_one(run)
+    print(f"Prefetch finished: {run['fetched']}/{run['requested']} cached ({run['coverage']}%, "
+          f"{run['already_cached']} already final) for {len(users)} users in {run['duration_seconds']}s")
+    return run
+
+
+def backfill_daily_data(start_date, end_date, data_types, users=None):
+    """
+    Fill the local cache for every day between start_date and end_date (YYYY-MM-DD)
+    under the same request budget as the scheduled prefetch. Holds the prefetch lock,
+    so scheduled runs are skipped while a backfill is in progress.
+    """
+    if not acquire_prefetch_lock():
+        print("Prefetch already running in another process, not backfilling")
+        return None
+
+    day = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    targets = []
+    while day <= end:
+        targets.extend((data_type, day.strftime("%Y-%m-%d")) for data_type in data_types)
+        day += timedelta(days=1)
+    users = users or get_registered_users()
+
+    run = cache_daily_data(targets, users)
+    print(f"Backfill finished: {run['fetched']}/{run['requested']} cached ({run['coverage']}%, "
+          f"{run['already_cached']} already final) for {len(users)} users in {run['duration_seconds']}s")
+    return run
+
+
+def get_last_prefetch_run():
+    return prefetch_runs_collection.find_one({}, {"_id": 0}, sort=[("started_at", -1)])
+
+
+scheduler = None
+
+
+def start_prefetch_scheduler():
+    """
+    Schedule prefetch_daily_data at each HH:MM in PREFETCH_TIMES, once per process.
+    A single job is used so overlapping runs never double the request rate.
+    """
+    global scheduler
+    if scheduler:
+        return scheduler
+    if PREFETCH_ENABLED.lower() != "true":
+        print("Prefetch disabled (PREFETCH_ENABLED is not true)")
+        return None
+
+    triggers = []
+    for run_time in PREFETCH_TIMES.split(","):
+        hour, minute = run_time.strip().split(":")
+        triggers.append(CronTrigger(hour=int(hour), minute=int(minute)))
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(
+        prefetch_daily_data,
+        OrTrigger(triggers),
+        id="prefetch_daily_data",
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=3600
+    )
+    scheduler.start()
+    print(f"Prefetch scheduled at {PREFETCH_TIMES}")
+    return scheduler
+
+
+if __name__ == '__main__':
+    prefetch_daily_data()
@@ -8,8 +8,9 @@ from auth import get_fitbit_session
 from config import VERIFICATION_CODE
 from health_data import analyze_and_store_panic_attacks, panic_attacks_collection
 from flask import Blueprint, jsonify
+from prefetch import get_last_prefetch_run
 from service import fetch_with_backoff, get_last_processed_date, update_last_processed_date, fetch_fitbit_data, \
-    format_response, get_intraday_heart_rate, get_sleep_data
+    format_response, get_intraday_heart_rate, get_sleep_data, get_cached_data
 
 routes = Blueprint('routes', __name__)
 
@@ -47,8 +48,7 @@ def get_panic_attacks():
 @routes.route('/api/sleep-data', methods=['GET'])
 def get_irregular_rhythm_notification():
     date = request.args.get('date')
-    fitbit = get_fitbit_session()
-    sleep_data = fetch_with_backoff(f'https://api.fitbit.com/1.2/user/-/sleep/date/{date}.json', fitbit)
+    sleep_data = get_cached_data("sleep", date)
     print("sleep_data", sleep_data)
 
     return sleep_data, 200
@@ -170,6 +170,14 @@ def user_summary():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@cross_origin()
+@routes.route('/api/prefetch-status', methods=['GET'])
+def get_prefetch_status():
+    last_run = get_last_prefetch_run()
+    if not last_run:
+        return jsonify({"error": "No prefetch run recorded yet"}), 404
+    return jsonify(last_run), 200
+
 @cross_origin()
 @routes.route('/api/alert-history', methods=['GET'])
 def get_alert_history():
@@ -3,11 +3,23 @@ import time
 from datetime import datetime, timedelta
 
 from auth import get_fitbit_session
-from health_data import last_processed_collection
+from config import CACHE_TTL_MINUTES, HEART_RATE_CACHE_TTL_MINUTES, CACHE_FINAL_AFTER_HOURS
+from health_data import last_processed_collection, fitbit_cache_collection
 
 MAX_RETRIES = 5
 INITIAL_BACKOFF = 2  # initial backoff in seconds
 
+# Daily Fitbit endpoints served from the local cache, keyed by data type
+DAILY_DATA_URLS = {
+    "sleep": "https://api.fitbit.com/1.2/user/-/sleep/date/{date}.json",
+    "heart_rate": "https://api.fitbit.com/1/user/-/activities/heart/date/{date}/1d/1min.json",
+    "hrv": "https://api.fitbit.com/1/user/-/hrv/date/{date}/all.json",
+    "breathing_rate": "https://api.fitbit.com/1/user/-/br/date/{date}/all.json",
+}
+
+# Daily data types only recorded once the user has slept and synced
+SLEEP_DATA_TYPES = ["sleep", "hrv", "breathing_rate"]
+
 
 def get_last_processed_date():
     last_entry = last_processed_collection.find_one({"type": "last_processed_date"})
@@ -53,23 +65,92 @@ def fetch_with_backoff(url, fitbit_session):
     print("Max retries reached. Could not retrieve data.")
     return None
 
+def normalize_date(date):
+    """
+    Turn "today" into an ISO date and reject anything that isn't YYYY-MM-DD.
+    """
+    if date == "today":
+        return datetime.today().strftime("%Y-%m-%d")
+    try:
+        return datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+
+
+def has_daily_data(data_type, data):
+    """
+    Whether a Fitbit response actually contains readings rather than an empty day.
+    """
+    if data_type == "heart_rate":
+        return bool(data.get("activities-heart-intraday", {}).get("dataset"))
+    key = {"sleep": "sleep", "hrv": "hrv", "breathing_rate": "br"}[data_type]
+    return bool(data.get(key))
+
+
+def is_cache_final(cached, date):
+    """
+    Data fetched CACHE_FINAL_AFTER_HOURS after its day ended won't change anymore.
+    Earlier fetches, like the pre-dawn prefetch, may predate the device's last sync.
+    """
+    day_end = datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)
+    return cached["fetched_at"] >= day_end + timedelta(hours=int(CACHE_FINAL_AFTER_HOURS))
+
+
+def is_cache_fresh(cached, date):
+    """
+    Final data is always fresh, anything fetched earlier stays fresh for CACHE_TTL_MINUTES,
+    or HEART_RATE_CACHE_TTL_MINUTES for heart rate which is shown as live data.
+    """
+    if is_cache_final(cached, date):
+        return True
+    # An empty day fetched before the user synced is refetched instead of served until the TTL runs out
+    if not has_daily_data(cached["type"], cached["data"]):
+        return False
+    ttl = HEART_RATE_CACHE_TTL_MINUTES if cached["type"] == "heart_rate" else CACHE_TTL_MINUTES
+    return datetime.now() - cached["fetched_at"] <= timedelta(minutes=int(ttl))
+
+
+def get_cached_data(data_type, date, user="default", fitbit_session=None, refresh=False):
+    """
+    Helper function to read daily Fitbit data from the local cache,
+    fetching and storing it on a miss. Pass refresh=True to always fetch.
+    """
+    date = normalize_date(date)
+    if date is None:
+        return None
+
+    if not refresh:
+        cached = fitbit_cache_collection.find_one({"user": user, "type": data_type, "date": date})
+        if cached and is_cache_fresh(cached, date):
+            return cached["data"]
+
+    fitbit = fitbit_session or get_fitbit_session(user)
+    if not fitbit:
+        return None
+
+    data = fetch_with_backoff(DAILY_DATA_URLS[data_type].format(date=date), fitbit)
+    if data is not None:
+        fitbit_cache_collection.update_one(
+            {"user": user, "type": data_type, "date": date},
+            {"$set": {"data": data, "fetched_at": datetime.now()}},
+            upsert=True)
+    return data
+
 # Fetch data from Fitbit API
 def fetch_fitbit_data():
     fitbit = get_fitbit_session()
+    today = datetime.today().strftime("%Y-%m-%d")
 
     # Fetch sleep data
-    sleep_response = fitbit.get("https://api.fitbit.com/1.2/user/-/sleep/date/today.json")
-    sleep_data = sleep_response.json()
+    sleep_data = get_cached_data("sleep", today, fitbit_session=fitbit) or {}
     print(sleep_data)
 
-    # Fetch heart rate data
-    hr_response = fitbit.get("https://api.fitbit.com/1/user/-/activities/heart/date/today/1d.json")
-    hr_data = hr_response.json()
+    # Fetch heart rate data (the intraday response also carries the daily summary)
+    hr_data = get_cached_data("heart_rate", today, fitbit_session=fitbit) or {}
     print(hr_data)
 
     # Fetch breathing rate data (if available)
-    br_response = fitbit.get("https://api.fitbit.com/1/user/-/br/date/today/all.json")
-    br_data = br_response.json()
+    br_data = get_cached_data("breathing_rate", today, fitbit_session=fitbit) or {}
     print(br_data)
 
     profile_response = fitbit.get("https://api.fitbit.com/1/user/-/profile.json")
@@ -88,7 +169,10 @@ def format_response(sleep_data, hr_data, br_data, profile_data):
         sleep_duration = "N/A"
 
     # Extract heart rate data
-    resting_heart_rate = hr_data['activities-heart'][0]['value'].get('restingHeartRate', "N/A")
+    if 'activities-heart' in hr_data and hr_data['activities-heart']:
+        resting_heart_rate = hr_data['activities-heart'][0]['value'].get('restingHeartRate', "N/A")
+    else:
+        resting_heart_rate = "N/A"
     heart_rate = f"{resting_heart_rate} BPM" if resting_heart_rate != "N/A" else "N/A"
     avg_breathing_rate = "N/A"
     # Extract breathing rate data
@@ -116,9 +200,7 @@ def format_response(sleep_data, hr_data, br_data, profile_data):
     return response
 
 def get_intraday_heart_rate(date):
-    fitbit = get_fitbit_session()
-    url = f"https://api.fitbit.com/1/user/-/activities/heart/date/{date}/1d/1min.json"
-    data = fetch_with_backoff(url, fitbit)
+    data = get_cached_data("heart_rate", date)
 
     if not data or "activities-heart-intraday" not in data:
         return {"error": "No intraday heart rate data available"}
@@ -166,9 +248,7 @@ def get_intraday_heart_rate(date):
     }
 
 def get_sleep_data(date):
-    fitbit = get_fitbit_session()
-    url = f"https://api.fitbit.com/1.2/user/-/sleep/date/{date}.json"
-    data = fetch_with_backoff(url, fitbit)
+    data = get_cached_data("sleep", date)
 
     if not data or "sleep" not in data or not data["sleep"]:
         return {"error": "No sleep data available for the given date"}